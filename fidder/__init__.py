@@ -25,12 +25,13 @@
 # *
 # **************************************************************************
 import os
+from os.path import join, dirname
 import pwem
 from fidder.constants import FIDDER_ENV_ACTIVATION, FIDDER_DEFAULT_ACTIVATION_CMD, FIDDER_DEFAULT_VERSION, FIDDER, \
-    FIDDER_CUDA_LIB, V0_0_8, FIDDER_HOME, FIDDER_ENV_NAME
+    FIDDER_CUDA_LIB, V0_0_8, FIDDER_HOME, FIDDER_ENV_NAME, FIDDER_TS_SCRIPT
 from pyworkflow.utils import Environ
 
-__version__ = '3.1.1'
+__version__ = '3.2.0'
 _logo = "icon.png"
 # _references = ['']
 
@@ -39,6 +40,7 @@ class Plugin(pwem.Plugin):
     _pathVars = [FIDDER_CUDA_LIB]
     _supportedVersions = [V0_0_8]
     _url = "https://github.com/scipion-em/scipion-em-fidder"
+    _fidderEnvCmd = None
 
     @classmethod
     def _defineVariables(cls):
@@ -58,6 +60,7 @@ class Plugin(pwem.Plugin):
             del environ['PYTHONPATH']
         cudaLib = cls.getVar(FIDDER_CUDA_LIB, pwem.Config.CUDA_LIB)
         environ.addLibrary(cudaLib)
+        return environ
 
     @classmethod
     def defineBinaries(cls, env):
@@ -96,11 +99,32 @@ class Plugin(pwem.Plugin):
             neededProgs.append('conda')
         return neededProgs
 
+    @classmethod
+    def getFidderTsScript(cls):
+        return join(dirname(__file__), 'scripts', FIDDER_TS_SCRIPT)
+
+    @classmethod
+    def _getFidderEnvCmd(cls):
+        """ Command prefix to run a program within the fidder environment. It is built once, as the
+        variables it depends on do not change during the execution. """
+        if cls._fidderEnvCmd is None:
+            cmd = cls.getCondaActivationCmd() + " "
+            cmd += cls.getFidderEnvActivation()
+            cmd += " && CUDA_VISIBLE_DEVICES=%(GPU)s "
+            cls._fidderEnvCmd = cmd
+        return cls._fidderEnvCmd
+
     @classmethod
     def runFidder(cls, protocol, args, cwd=None, numberOfMpi=1):
         """ Run fidder command from a given protocol. """
-        cmd = cls.getCondaActivationCmd() + " "
-        cmd += cls.getFidderEnvActivation()
-        cmd += f" && CUDA_VISIBLE_DEVICES=%(GPU)s {FIDDER} "
+        cmd = cls._getFidderEnvCmd() + f"{FIDDER} "
         protocol.runJob(cmd, args, env=cls.getEnviron(), cwd=cwd, numberOfMpi=numberOfMpi)
 
+    @classmethod
+    def runFidderTs(cls, protocol, args, cwd=None):
+        """ Run the fidder tilt-series script from a given protocol. Contrary to the fidder command,
+        which is executed once per image, the script loads the U-Net once and processes all the
+        tilt images of a tilt-series within the same process. """
+        cmd = cls._getFidderEnvCmd() + f"python {cls.getFidderTsScript()} "
+        protocol.runJob(cmd, args, env=cls.getEnviron(), cwd=cwd)
+
@@ -35,4 +35,7 @@ FIDDER_DEFAULT_VERSION = V0_0_8
 FIDDER_ENV_NAME = '%s-%s' % (FIDDER, FIDDER_DEFAULT_VERSION)
 FIDDER_ENV_ACTIVATION = 'FIDDER_ENV_ACTIVATION'
 FIDDER_DEFAULT_ACTIVATION_CMD = 'conda activate %s' % FIDDER_ENV_NAME
-FIDDER_CUDA_LIB = 'FIDDER_CUDA_LIB'
\ No newline at end of file
+FIDDER_CUDA_LIB = 'FIDDER_CUDA_LIB'
+
+# Script executed within the fidder environment to process a whole tilt-series in a single process
+FIDDER_TS_SCRIPT = 'fidder_ts.py'
@@ -24,38 +24,36 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
-import glob
 import logging
-import shutil
 import time
 from enum import Enum
-from os.path import join, basename
 from typing import Union, List, Counter
-import mrcfile
-import numpy as np
-from typing_extensions import Tuple
 from fidder import Plugin
-from pwem.emlib import DT_FLOAT
-from pwem.emlib.image import ImageHandler
 from pwem.protocols import EMProtocol
 from pyworkflow.object import Set, Pointer
 from pyworkflow.protocol import PointerParam, FloatParam, GT, LE, GPU_LIST, StringParam, BooleanParam, LEVEL_ADVANCED, \
-    STEPS_PARALLEL, ProtStreamingBase
-from pyworkflow.utils import Message, makePath, cyanStr, redStr
+    STEPS_PARALLEL, ProtStreamingBase, IntParam, GE, EnumParam
+from pyworkflow.utils import Message, cyanStr, redStr
 from tomo.objects import SetOfTiltSeries, TiltSeries, TiltImage
 
 logger = logging.getLogger(__name__)
 # Form variables
 IN_TS_SET = 'inTsSet'
 PROB_THRESHOLD = 'probThreshold'
+BATCH_SIZE = 'batchSize'
+COMPILE_MODEL = 'compileModel'
+PRECISION = 'precision'
 # Auxiliar variables
-MRC = '.mrc'
 MRCS = '.mrcs'
-OUT_MASKS_DIR = 'masks'
-OUT_TS_DIR = 'results'
 EVEN_SUFFIX = '_even'
 ODD_SUFFIX = '_odd'
 MASK_SUFFIX = '_mask'
+# Inference precisions (as expected by the fidder script)
+PRECISION_CHOICES = ['fp32', 'bf16', 'fp16']
+BF16_PRECISION = 1
+# Streaming: time (s) between checks of the input set for new tilt-series
+MIN_POLLING_TIME = 0.5
+MAX_POLLING_TIME = 10
 # Other variables
 OUTPUT_TS_FAILED_NAME = "FailedTiltSeries"
 
@@ -78,7 +76,8 @@ class ProtFidderDetectAndEraseFiducials(EMProtocol, ProtStreamingBase):
         self.itemTsIdReadList = []
         self.failedItems = []
         self.sRate = -1
-        self.ih = ImageHandler()
+        self.fidderCommonArgs = ''
+        self.tsDict = {}
 
     @classmethod
     def worksInStreaming(cls):
@@ -106,16 +105,47 @@ class ProtFidderDetectAndEraseFiducials(EMProtocol, ProtStreamingBase):
                       help='If set to Yes, the stack generated for each tilt-series with fiducial-based '
                            'segmentation will be saved (but not registered as Scipion objects. They can be '
                            'found in the protocol directory > extra.')
+        form.addParam(BATCH_SIZE, IntParam,
+                      default=8,
+                      validators=[GE(0)],
+                      label='Batch size',
+                      expertLevel=LEVEL_ADVANCED,
+                      help='Maximum number of image tiles processed simultaneously by the U-Net. Higher values '
+                           'make a better use of the GPU at the cost of a higher GPU memory consumption. If 0, the '
+                           'largest batch size that fits in the free GPU memory is used. Do not use it if '
+                           'several tilt-series can be processed at the same time on the same GPU, as each one '
+                           'would take most of the free memory.')
+        form.addParam(PRECISION, EnumParam,
+                      choices=PRECISION_CHOICES,
+                      default=BF16_PRECISION,
+                      display=EnumParam.DISPLAY_HLIST,
+                      label='Inference precision',
+                      expertLevel=LEVEL_ADVANCED,
+                      help='Floating point precision used by the U-Net. The mixed precisions (bf16 and fp16) '
+                           'are faster and use less GPU memory, with a negligible effect on the predicted '
+                           'masks as the probabilities are thresholded. If the GPU does not support bf16 '
+                           '(older than Ampere), fp32 is used instead.')
+        form.addParam(COMPILE_MODEL, BooleanParam,
+                      default=False,
+                      label='Compile the U-Net?',
+                      expertLevel=LEVEL_ADVANCED,
+                      help='If set to Yes, the U-Net is compiled (torch.compile) before the inference. The '
+                           'compilation takes some time for each tilt-series, so it pays off with large '
+                           'tilt-series. It requires torch 2.0 or higher in the fidder environment.')
         form.addHidden(GPU_LIST, StringParam,
                        default='0',
                        label="Choose GPU IDs")
-        form.addParallelSection(threads=2, mpi=0)
+        # One thread runs the steps generator, so at least two more are needed for the GPU step of a tilt-series
+        # to overlap with the output creation of the previous one
+        form.addParallelSection(threads=3, mpi=0)
 
     # --------------------------- INSERT steps functions ----------------------
     def stepsGeneratorStep(self) -> None:
         closeSetStepDeps = []
+        sleepTime = MIN_POLLING_TIME
         inTsSet = self._getInTsSet()
-        self.sRate = self._getInTsSet().getSamplingRate()
+        self.sRate = inTsSet.getSamplingRate()
+        self.fidderCommonArgs = self._getFidderCommonArgs()
         self.readingOutput()
 
         while True:
@@ -130,14 +160,15 @@ class ProtFidderDetectAndEraseFiducials(EMProtocol, ProtStreamingBase):
                                          prerequisites=closeSetStepDeps,
                                          needsGPU=False)
                 break
+            newTsFound = False
             for ts in inTsSet.iterItems():
                 tsId = ts.getTsId()
                 if tsId not in self.itemTsIdReadList and ts.getSize() > 0:  # Avoid processing empty TS (before the Tis are added)
-                    cInputId = self._insertFunctionStep(self.convertInputStep, tsId,
-                                                        prerequisites=[],
-                                                        needsGPU=False)
+                    # Keep a copy of the tilt-series and its tilt images, so they are not queried again later
+                    self.tsDict[tsId] = (ts.clone(ignoreAttrs=[]),
+                                         [ti.clone() for ti in ts.iterItems(orderBy=TiltImage.INDEX_FIELD)])
                     predFidId = self._insertFunctionStep(self.predictAndEraseFiducialMaskStep, tsId,
-                                                         prerequisites=cInputId,
+                                                         prerequisites=[],
                                                          needsGPU=True)
                     cOutId = self._insertFunctionStep(self.createOutputStep, tsId,
                                                       prerequisites=predFidId,
@@ -145,63 +176,50 @@ class ProtFidderDetectAndEraseFiducials(EMProtocol, ProtStreamingBase):
                     closeSetStepDeps.append(cOutId)
                     logger.info(cyanStr(f"Steps created for tsId = {tsId}"))
                     self.itemTsIdReadList.append(tsId)
-            time.sleep(10)
+                    newTsFound = True
+            # Exponential backoff: responsive while the tilt-series keep arriving, without polling the input set
+            # too often when they do not
+            sleepTime = MIN_POLLING_TIME if newTsFound else min(2 * sleepTime, MAX_POLLING_TIME)
+            time.sleep(sleepTime)
             if inTsSet.isStreamOpen():
                 with self._lock:
                     inTsSet.loadAllProperties()  # refresh status for the streaming
 
     # -------------------------- STEPS functions ------------------------------
-    def convertInputStep(self, tsId: str):
-        logger.info(cyanStr(f'===> tsId = {tsId}: Unstacking...'))
-        ts = self._getCurrentItem(tsId)
-        tsFileName = ts.getFirstItem().getFileName()
-        # Create the necessary directories in tmp
-        self._createTmpDirs(tsId, doEvenOdd=self.doEvenOdd.get())
-        # Fidder works with individual MRC images --> the tilt-series must be un-stacked
-        for i, ti in enumerate(ts.iterItems(orderBy=TiltImage.INDEX_FIELD)):
-            index = i + 1
-            self._generateUnstakedImg(tsId, tsFileName, index)
-
     def predictAndEraseFiducialMaskStep(self, tsId: str):
         logger.info(cyanStr(f'===> tsId = {tsId}: Predicting the fiducial mask and erasing them...'))
         try:
-            self._runFidder(tsId)
-            # Odd/Even
-            if self.doEvenOdd.get():
-                self._runFidder(tsId, suffix=EVEN_SUFFIX)
-                self._runFidder(tsId, suffix=ODD_SUFFIX)
+            t0 = time.time()
+            # The tilt images stored by the steps generator are used, so the input set is not queried again
+            _, inTiList = self.tsDict[tsId]
+            # The tilt-series stack (and the even/odd ones) are directly read by the fidder script, so
+            # there is no need to un-stack them and mount the results afterward
+            Plugin.runFidderTs(self, self._getFidderTsArgs(tsId, inTiList[0]))
+            logger.info(cyanStr(f'===> tsId = {tsId}: {len(inTiList)} tilt images processed in '
+                                f'{time.time() - t0:.2f} s'))
         except Exception as e:
             self.failedItems.append(tsId)
             logger.error(redStr(f'Fidder execution failed for tsId {tsId} -> {e}'))
 
     def createOutputStep(self, tsId: str):
+        logger.info(cyanStr(f'===> tsId = {tsId}: Creating the resulting tilt-series...'))
+        inTs, inTiList = self.tsDict.pop(tsId)
+        failed = tsId in self.failedItems
+        if not failed:
+            # The tilt images are generated before acquiring the lock, which is only needed to update the sets
+            newTiList = self._genOutputTiList(tsId, inTiList)
         with self._lock:
-            logger.info(cyanStr(f'===> tsId = {tsId}: Creating the resulting tilt-series...'))
-            inTs = self._getCurrentItem(tsId, doLock=False)
-            if tsId in self.failedItems:
-                self.createOutputFailedSet(inTs)
+            if failed:
+                self.createOutputFailedSet(self._getCurrentItem(tsId, doLock=False))
                 failedTs = getattr(self, OUTPUT_TS_FAILED_NAME, None)
                 if failedTs:
                     failedTs.close()
             else:
-                doEvenOdd = self.doEvenOdd.get()
-                if self.saveMaskStack.get():
-                    # Mount the segmented stack
-                    self._mountSegmentedStack(tsId)
-
-                # Mount the resulting tilt-series
-                tsFName, tsFnameEven, tsFnameOdd = self._mountTiltSeries(tsId, doEvenOdd=doEvenOdd)
                 outTsSet = self._getOutputTsSet()
                 newTs = TiltSeries()
                 newTs.copyInfo(inTs)
                 outTsSet.append(newTs)
-
-                for inTi in inTs.iterItems(orderBy=TiltImage.INDEX_FIELD):
-                    newTi = TiltImage()
-                    newTi.copyInfo(inTi)
-                    newTi.setFileName(tsFName)
-                    if doEvenOdd:
-                        newTi.setOddEven([tsFnameOdd, tsFnameEven])
+                for newTi in newTiList:
                     newTs.append(newTi)
 
                 newTs.write()
@@ -213,17 +231,12 @@ class ProtFidderDetectAndEraseFiducials(EMProtocol, ProtStreamingBase):
                     if output:
                         output.close()
 
-        # Clean the current ts folder/s in /tmp
-        tsIdTmpDir = self._getTmpPath(tsId)
-        if tsIdTmpDir:
-            shutil.rmtree(tsIdTmpDir)
-
     # --------------------------- UTILS functions -----------------------------
     def readingOutput(self) -> None:
         outTsSet = getattr(self, self._possibleOutputs.tiltSeries.name, None)
         if outTsSet:
-            for item in outTsSet:
-                self.itemTsIdReadList.append(item.getTsId())
+            # A single query of the tsId column, instead of loading each tilt-series
+            self.itemTsIdReadList.extend(outTsSet.getTSIds())
             self.info(cyanStr(f'TsIds processed: {self.itemTsIdReadList}'))
         else:
             self.info(cyanStr('No tilt-series have been processed yet'))
@@ -239,92 +252,56 @@ class ProtFidderDetectAndEraseFiducials(EMProtocol, ProtStreamingBase):
         else:
             return self._getInTsSet().getItem(TiltSeries.TS_ID_FIELD, tsId)
 
-    def _getCurrentTsTmpDir(self, tsId: str) -> str:
-        return self._getTmpPath(tsId)
-
-    def _getUnstackedImgsDir(self, tsId: str, suffix: str = '') -> str:
-        return join(self._getCurrentTsTmpDir(tsId), 'unstackedImgs' + suffix)
-
-    def _getUnstackedMasksDir(self, tsId: str, suffix: str = '') -> str:
-        return join(self._getCurrentTsTmpDir(tsId), 'unstackedMasks' + suffix)
-
-    def _getUnstackedErasedImgsDir(self, tsId: str, suffix: str = '') -> str:
-        return join(self._getCurrentTsTmpDir(tsId), 'unstackedResults' + suffix)
-
-    def _getOutputMaskFileName(self, tsId: str, inImageFileName: str, suffix: str = '') -> str:
-        return join(self._getUnstackedMasksDir(tsId), basename(inImageFileName) + suffix)
-
-    def _getOutputImgFileName(self, tsId: str, inImageFileName: str, suffix: str = '') -> str:
-        return join(self._getUnstackedErasedImgsDir(tsId, suffix=suffix), basename(inImageFileName))
+    def _genOutputTiList(self, tsId: str, inTiList: List[TiltImage]) -> List[TiltImage]:
+        doEvenOdd = self.doEvenOdd.get()
+        tsFName = self._getTsNewFileName(tsId)
+        tsFnameEven = self._getTsNewFileName(tsId, suffix=EVEN_SUFFIX)
+        tsFnameOdd = self._getTsNewFileName(tsId, suffix=ODD_SUFFIX)
+        newTiList = []
+        for inTi in inTiList:
+            newTi = TiltImage()
+            newTi.copyInfo(inTi)
+            newTi.setFileName(tsFName)
+            if doEvenOdd:
+                newTi.setOddEven([tsFnameOdd, tsFnameEven])
+            newTiList.append(newTi)
+        return newTiList
 
     def _getTsNewFileName(self, tsId, suffix: str = '') -> str:
         return self._getExtraPath(f'{tsId}{suffix}{MRCS}')
 
-    @staticmethod
-    def _getNewTiFileName(tsId: str, index: int, suffix: str = '') -> str:
-        return f'{tsId}_{index:03}{suffix}{MRC}'
-
-    def _getNewTiTmpFileName(self, tsId: str, index: int, suffix: str = '') -> str:
-        return join(self._getUnstackedImgsDir(tsId, suffix=suffix),
-                    self._getNewTiFileName(tsId, index, suffix=suffix))
-
-    def _createTmpDirs(self, tsId: str, doEvenOdd: bool = False) -> None:
-        currentTsTmpDir = self._getCurrentTsTmpDir(tsId)
-        inImgsDir = self._getUnstackedImgsDir(tsId)
-        masksDir = self._getUnstackedMasksDir(tsId)
-        outImgsDir = self._getUnstackedErasedImgsDir(tsId)
-        dirList = [currentTsTmpDir,
-                   inImgsDir,
-                   masksDir,
-                   outImgsDir]
-        if doEvenOdd:
-            outImgsDirEven = self._getUnstackedErasedImgsDir(tsId, suffix=EVEN_SUFFIX)
-            outImgsDirOdd = self._getUnstackedErasedImgsDir(tsId, suffix=ODD_SUFFIX)
-            evenOdddirList = [outImgsDirEven,
-                              outImgsDirOdd]
-            dirList.extend(evenOdddirList)
-        makePath(*dirList)
-
-    def _getPredictArgs(self, inImage: str, outMask: str) -> str:
+    def _getFidderCommonArgs(self) -> str:
+        """Arguments of the fidder script shared by all the tilt-series. They are generated once by the
+        steps generator."""
         cmd = [
-            'predict',
-            f'--input-image {inImage}',
-            f'--output-mask {outMask}',
             f'--pixel-spacing {self.sRate:.3f}',
-            f'--probability-threshold {getattr(self, PROB_THRESHOLD).get():.2f}'
+            f'--probability-threshold {getattr(self, PROB_THRESHOLD).get():.2f}',
+            f'--batch-size {getattr(self, BATCH_SIZE).get()}',
+            f'--precision {PRECISION_CHOICES[getattr(self, PRECISION).get()]}'
         ]
+        if getattr(self, COMPILE_MODEL).get():
+            cmd.append('--compile')
         return ' '.join(cmd)
 
-    @staticmethod
-    def _getEraseFidArgs(inImage: str, maskedImage: str, outImage: str) -> str:
+    def _getFidderTsArgs(self, tsId: str, firstTi: TiltImage) -> str:
         cmd = [
-            'erase',
-            f'--input-image {inImage}',
-            f'--input-mask {maskedImage}',
-            f'--output-image {outImage}'
+            f'--input-stack {firstTi.getFileName()}',
+            f'--output-stack {self._getTsNewFileName(tsId)}',
+            self.fidderCommonArgs
         ]
+        if self.saveMaskStack.get():
+            cmd.append(f'--output-mask {self._getTsNewFileName(tsId, suffix=MASK_SUFFIX)}')
+        if self.doEvenOdd.get():
+            # The even/odd tilt-series are erased using the masks predicted for the whole tilt-series
+            tsFileNameOdd, tsFileNameEven = firstTi.getOddEven()
+            cmd.extend([
+                f'--input-even {tsFileNameEven}',
+                f'--output-even {self._getTsNewFileName(tsId, suffix=EVEN_SUFFIX)}',
+                f'--input-odd {tsFileNameOdd}',
+                f'--output-odd {self._getTsNewFileName(tsId, suffix=ODD_SUFFIX)}'
+            ])
         return ' '.join(cmd)
 
-    def _runFidder(self, tsId: str, suffix: str = ''):
-        imagesList = glob.glob(join(self._getUnstackedImgsDir(tsId, suffix=suffix), '*' + MRC))
-        nImgs = len(imagesList)
-        for i, inImage in enumerate(sorted(imagesList)):
-            logger.info(cyanStr(f'======> tsId = {tsId}{suffix}: processing image {i + 1} of {nImgs}'))
-            outImgMask = self._getOutputMaskFileName(tsId, inImage)
-            outResultImg = self._getOutputImgFileName(tsId, inImage, suffix=suffix)
-            # Predict: only for the whole TS
-            if not suffix:
-                args = self._getPredictArgs(inImage, outImgMask)
-                Plugin.runFidder(self, args)
-            # Erase: do always this part, no matter if it's the whole TS, the even or the odd
-            args = self._getEraseFidArgs(inImage, outImgMask, outResultImg)
-            Plugin.runFidder(self, args)
-
-    def _generateUnstakedImg(self, tsId: str, tsFileName: str, index: int, suffix: str = '') -> None:
-        newTiFileName = self._getNewTiTmpFileName(tsId, index, suffix=suffix)
-        tiFName = f'{index}@{tsFileName}:mrcs'
-        self.ih.convert(tiFName, newTiFileName, DT_FLOAT)
-
     def _getOutputTsSet(self) -> SetOfTiltSeries:
         outSetSetAttrib = self._possibleOutputs.tiltSeries.name
         outTsSet = getattr(self, outSetSetAttrib, None)
@@ -338,60 +315,6 @@ class ProtFidderDetectAndEraseFiducials(EMProtocol, ProtStreamingBase):
             self._defineSourceRelation(self._getInTsSet(returnPointer=True), outTsSet)
         return outTsSet
 
-    def _mountCurrentStack(self, tsId: str, imagesDir: str, suffix: str = '') -> str:
-        logger.info(cyanStr(f'===> tsId = {tsId}{suffix}: mounting the stack file...'))
-        outStackFile = self._getTsNewFileName(tsId, suffix=suffix)
-        resultImgs = sorted(glob.glob(join(imagesDir, '*' + MRC)))
-
-        # Read the first image to get the dimensions
-        with mrcfile.mmap(resultImgs[0], mode='r+') as mrc:
-            img = mrc.data
-            nx, ny = img.shape
-
-        # Create an empty array in which the stack of images will be stored
-        shape = (len(resultImgs), nx, ny)
-        stackArray = np.empty(shape, dtype=img.dtype)
-
-        # Fill it with the images sorted by angle
-        for i, img in enumerate(resultImgs):
-            with mrcfile.mmap(img) as mrc:
-                logger.info(f'Inserting image - index [{i}], {img}')
-                stackArray[i] = mrc.data
-
-        # Save the stack in a new mrc file
-        with mrcfile.new_mmap(outStackFile, shape, overwrite=True) as mrc:
-            mrc.set_data(stackArray)
-            mrc.update_header_from_data()
-            mrc.update_header_stats()
-            mrc.voxel_size = self.sRate
-        return outStackFile
-
-    def _mountSegmentedStack(self, tsId: str) -> None:
-        self._mountCurrentStack(tsId,
-                                self._getUnstackedMasksDir(tsId),
-                                suffix=MASK_SUFFIX)
-
-    def _mountTiltSeries(self, tsId: str, doEvenOdd: bool=False) -> Tuple[str, str, str]:
-        resultingTsFileNameEven = ''
-        resultingTsFileNameOdd = ''
-        unstackedErasedImgsDir = self._getUnstackedErasedImgsDir(tsId)
-        resultingTsFileName = self._mountCurrentStack(tsId, unstackedErasedImgsDir)
-        if doEvenOdd:
-            # Even
-            unstackedErasedImgsDirEven = self._getUnstackedErasedImgsDir(tsId,
-                                                                         suffix=EVEN_SUFFIX)
-            resultingTsFileNameEven = self._mountCurrentStack(tsId,
-                                                              unstackedErasedImgsDirEven,
-                                                              suffix=EVEN_SUFFIX)
-            # Odd
-            unstackedErasedImgsDirOdd = self._getUnstackedErasedImgsDir(tsId,
-                                                                        suffix=ODD_SUFFIX)
-            resultingTsFileNameOdd = self._mountCurrentStack(tsId,
-                                                             unstackedErasedImgsDirOdd,
-                                                             suffix=ODD_SUFFIX)
-
-        return resultingTsFileName, resultingTsFileNameEven, resultingTsFileNameOdd
-
     def createOutputFailedSet(self, item):
         """ Just copy input item to the failed output set. """
         logger.info(f'Failed TS ---> {item.getTsId()}')
@@ -0,0 +1,566 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * National Center of Biotechnology, CSIC, Spain
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""Detect and erase the gold fiducials of all the tilt images of a tilt-series within a single process.
+
+This script is executed within the fidder environment (it is not imported by the plugin). The fidder CLI
+loads the U-Net and initializes the CUDA context once per image, while here it is done once per tilt-series.
+The tilt-series stacks are read directly (no un-stacking is required) and the erased tilt images are written
+directly into the memory-mapped output stacks.
+The predict + erase logic mirrors the one of the fidder commands predict and erase."""
+import argparse
+import contextlib
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Optional, List, Tuple, Sequence
+
+import mrcfile
+import numpy as np
+import torch
+import torch.nn.functional as F
+from scipy import ndimage as ndi
+from scipy.interpolate import LSQBivariateSpline
+from einops import rearrange
+from fidder.constants import TRAINING_PIXEL_SIZE, PIXELS_PER_FIDUCIAL, TRAINING_IMAGE_DIMENSIONS
+from fidder.model import Fidder, get_latest_checkpoint
+from fidder.utils import calculate_resampling_factor, rescale_2d_bicubic, rescale_2d_nearest, normalise_2d
+from tiler import Tiler, Merger
+
+# Inference precisions
+FP32 = 'fp32'
+BF16 = 'bf16'
+FP16 = 'fp16'
+AUTOCAST_DTYPES = {BF16: torch.bfloat16, FP16: torch.float16}
+# Tiling: same tiles as in Fidder.predict_step, but the overlapping regions are merged with a Hamming window,
+# which down-weights the tile borders (where the U-Net predictions are less reliable). A Hann window is not
+# used because it is zero at the borders, so the pixels at the edges of the image would have no weight
+TILE_OVERLAP = 0.35
+MERGE_WINDOW = 'hamming'
+# Automatic batch size: fraction of the free GPU memory used by the U-Net batches and batch size cap. The default
+# batch size is also used when the automatic one is requested without a GPU
+AUTO_BATCH_MEMORY_FRACTION = 0.8
+MAX_AUTO_BATCH_SIZE = 64
+CPU_BATCH_SIZE = 8
+# The tiles of up to this number of tilt images are pooled to fill the U-Net batches
+MAX_IMAGES_PER_GROUP = 8
+# Erasing parameters used by the fidder erase command
+BACKGROUND_MODEL_RESOLUTION = (8, 8)
+BACKGROUND_MODEL_SAMPLES = 25000
+BACKGROUND_STD_CROP = 0.25  # Fraction of the image height and width of the central crop used for the noise std
+
+
+def parseArgs() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--input-stack', required=True,
+                        help='Tilt-series stack in MRC format.')
+    parser.add_argument('--output-stack', required=True,
+                        help='Output stack with the fiducials erased.')
+    parser.add_argument('--output-mask', default=None,
+                        help='If provided, the stack of predicted fiducial masks is written in this file.')
+    parser.add_argument('--input-even', default=None,
+                        help='Even tilt-series stack, erased using the masks predicted for the input stack.')
+    parser.add_argument('--output-even', default=None,
+                        help='Output even stack with the fiducials erased.')
+    parser.add_argument('--input-odd', default=None,
+                        help='Odd tilt-series stack, erased using the masks predicted for the input stack.')
+    parser.add_argument('--output-odd', default=None,
+                        help='Output odd stack with the fiducials erased.')
+    parser.add_argument('--pixel-spacing', type=float, required=True,
+                        help='Pixel spacing in ångströms.')
+    parser.add_argument('--probability-threshold', type=float, default=0.5,
+                        help='Threshold above which pixels are considered part of a fiducial.')
+    parser.add_argument('--batch-size', type=int, default=CPU_BATCH_SIZE,
+                        help='Maximum number of tiles processed simultaneously by the U-Net. If 0, the largest '
+                             'one that fits in the free GPU memory is used.')
+    parser.add_argument('--precision', choices=[FP32, BF16, FP16], default=FP32,
+                        help='Floating point precision of the U-Net inference (mixed precision for bf16 and fp16).')
+    parser.add_argument('--compile', action='store_true',
+                        help='Compile the U-Net with torch.compile before the inference.')
+    return parser.parse_args()
+
+
+def loadModel(batchSize: int) -> Fidder:
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    # Inference only. All the tiles have the same shape, so the cuDNN autotuner only benchmarks the
+    # convolution algorithms for the first batch (and the last one, if smaller)
+    torch.set_grad_enabled(False)
+    torch.backends.cudnn.benchmark = True
+    # TF32 tensor cores (Ampere and newer GPUs) for the operations not covered by the autocast, and for the whole
+    # U-Net with the fp32 precision. The loss of precision is irrelevant, as the probabilities are thresholded
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    model = Fidder.load_from_checkpoint(get_latest_checkpoint(), map_location=device)
+    # map_location only applies to the checkpoint tensors: older Lightning versions keep the module on the CPU
+    model.to(device)
+    model.batch_size = batchSize
+    model.eval()
+    if device == 'cuda':
+        # NHWC layout, used by the fastest (tensor core) cuDNN convolution kernels
+        model.to(memory_format=torch.channels_last)
+    return model
+
+
+def compileForward(model: Fidder) -> None:
+    """Compile the U-Net forward once, so the generated kernels are reused for all the tiles of all the
+    tilt images (they all have the same shape)."""
+    if not hasattr(torch, 'compile'):  # torch < 2.0
+        print(f'torch.compile is not available in torch {torch.__version__}. The U-Net will not be compiled.',
+              flush=True)
+        return
+    model.forward = torch.compile(model.forward, mode='reduce-overhead')
+
+
+def openStack(fileName: Optional[str]) -> Optional[mrcfile.mrcfile.MrcFile]:
+    """The stacks are memory-mapped, so only the tilt image being processed is read from disk."""
+    return mrcfile.mmap(fileName, mode='r', permissive=True) if fileName else None
+
+
+def getStackData(mrc: mrcfile.mrcfile.MrcFile) -> np.ndarray:
+    data = mrc.data
+    return data[np.newaxis] if data.ndim == 2 else data
+
+
+def readImage(stack: np.ndarray, index: int) -> torch.Tensor:
+    # Always a copy: a view of a float32 memory-mapped stack would be read later, in the main thread
+    return torch.from_numpy(np.array(stack[index], dtype=np.float32))
+
+
+def submitReads(executor: ThreadPoolExecutor, stacks: List[Optional[np.ndarray]],
+                indices: Sequence[int]) -> List[List[Optional[Future]]]:
+    """Read (and cast to float32) the tilt images of the given indices from each stack in background threads."""
+    return [[executor.submit(readImage, stack, index) if stack is not None else None for stack in stacks]
+            for index in indices]
+
+
+def getResults(futures: List[List[Optional[Future]]]) -> List[List[Optional[torch.Tensor]]]:
+    return [[future.result() if future else None for future in indexFutures] for indexFutures in futures]
+
+
+def eraseInto(result: np.ndarray, stats: 'StackStats', indices: Sequence[int], images: List[torch.Tensor],
+              masks: List[torch.Tensor]) -> None:
+    """Erase the given tilt images of a stack, one after another (so its statistics are updated by a single
+    thread), into their sections of the result stack."""
+    for index, image, mask in zip(indices, images, masks):
+        result[index] = eraseImage(image, mask)
+        stats.add(result[index])
+
+
+def waitAll(futures: List[Optional[Future]]) -> None:
+    for future in futures:
+        if future:
+            future.result()  # Re-raises the exceptions of the thread, if any
+
+
+def newStack(fileName: Optional[str], shape: Tuple[int, ...], dtype: type) -> Optional[mrcfile.mrcfile.MrcFile]:
+    """Output stack, memory-mapped from the start, so each tilt image is written into it as soon as it is
+    produced, without keeping a copy of the whole stack in memory."""
+    if not fileName:
+        return None
+    return mrcfile.new_mmap(fileName, shape=shape, mrc_mode=mrcfile.utils.mode_from_dtype(np.dtype(dtype)),
+                            overwrite=True)
+
+
+def finishStack(mrc: mrcfile.mrcfile.MrcFile, stats: 'StackStats', pixelSpacing: float) -> None:
+    """Fill the header with the already accumulated statistics (mrcfile update_header_stats would compute
+    them again with several passes over the whole stack)."""
+    stats.updateHeader(mrc.header)
+    mrc.voxel_size = pixelSpacing
+
+
+class StackStats:
+    """Header statistics (min, max, mean and standard deviation, which mrcfile stores as rms) of a stack,
+    accumulated while its tilt images are produced."""
+
+    def __init__(self):
+        self.min = np.inf
+        self.max = -np.inf
+        self.sum = 0.0
+        self.sumSq = 0.0
+        self.count = 0
+
+    def add(self, image: np.ndarray) -> None:
+        image = image.astype(np.float64).ravel()
+        self.min = min(self.min, image.min())
+        self.max = max(self.max, image.max())
+        self.sum += image.sum()
+        self.sumSq += np.dot(image, image)
+        self.count += image.size
+
+    def updateHeader(self, header: np.recarray) -> None:
+        mean = self.sum / self.count
+        header.dmin = np.float32(self.min)
+        header.dmax = np.float32(self.max)
+        header.dmean = np.float32(mean)
+        header.rms = np.float32(np.sqrt(max(self.sumSq / self.count - mean ** 2, 0)))
+
+
+class FiducialPredictor:
+    """Predicts the fiducial masks of tilt images with an already loaded fidder U-Net. It mirrors
+    fidder.predict.predict_fiducial_mask, but the model is reused for all the tilt images."""
+
+    def __init__(self, model: Fidder, pixelSpacing: float, probThreshold: float, precision: str = FP32):
+        self.model = model
+        self.device = model.device
+        self.autocastDtype = self._getAutocastDtype(precision)
+        self.batchSize = model.batch_size or self._getMaxBatchSize()
+        self.pixelSpacing = pixelSpacing
+        self.probThreshold = probThreshold
+        # Two page-locked host buffers, used alternately to upload the tiles to the GPU through a dedicated
+        # copy stream, so the upload of a batch overlaps with the computation of the previous one. They are
+        # allocated once and reused
+        self._pinnedTiles = [None, None]
+        self._uploadEvents = [None, None]
+        # Two page-locked host buffers for the probabilities, which are downloaded asynchronously too
+        self._pinnedProbabilities = [None, None]
+        self._copyStream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+
+    def warmUp(self) -> None:
+        """Run the U-Net once on a full batch of blank tiles, so a compiled model is compiled before the first
+        tilt image. torch.compile compiles lazily, so its errors arise here: in that case, the compiled forward
+        is discarded and the U-Net runs in eager mode."""
+        tiles = torch.zeros((self.batchSize, 1) + tuple(TRAINING_IMAGE_DIMENSIONS), device=self.device)
+        try:
+            with torch.inference_mode(), self._getAutocast():
+                self.model(tiles)
+        except Exception as e:
+            print(f'The U-Net could not be compiled ({e}). It will run in eager mode.', flush=True)
+            del self.model.forward  # Remove the compiled forward, which was set as an instance attribute
+
+    def fitToImageShape(self, imageShape: Tuple[int, int]) -> int:
+        """Number of tilt images whose tiles are pooled in the U-Net batches. If a batch can hold the tiles of
+        whole tilt images, the batch size is reduced to the tiles of a group of up to MAX_IMAGES_PER_GROUP
+        images, so each group is exactly one full batch. Otherwise, the group is the smallest one whose tiles
+        fill all its batches, or MAX_IMAGES_PER_GROUP images if that one is larger (then the last batch of each
+        group is padded). A last group with fewer images is padded too. It must be called before compiling the
+        model, as it may reduce the batch size."""
+        tilesPerImage = self._getTiler(self._getDownscaledShape(imageShape)).n_tiles
+        if self.batchSize >= tilesPerImage:
+            groupSize = min(self.batchSize // tilesPerImage, MAX_IMAGES_PER_GROUP)
+            self.batchSize = groupSize * tilesPerImage
+            return groupSize
+        return min(self.batchSize // math.gcd(tilesPerImage, self.batchSize), MAX_IMAGES_PER_GROUP)
+
+    def predictMasks(self, images: List[torch.Tensor]) -> List[torch.Tensor]:
+        """(h, w) boolean fiducial masks of a group of (h, w) images. The probabilities (softmax) are always
+        computed in float32, also when using mixed precision."""
+        downscaledImages = [self._downscale(image) for image in images]
+        with torch.inference_mode(), self._getAutocast():
+            probabilities = self.predictProbabilities(downscaledImages)
+        masks = []
+        for imageProbabilities, image in zip(probabilities, images):
+            mask = probabilitiesToMask(imageProbabilities,
+                                       threshold=self.probThreshold,
+                                       minPixelCount=(PIXELS_PER_FIDUCIAL // 4))
+            mask = rearrange(torch.from_numpy(mask), 'h w -> 1 1 h w')
+            mask = rescale_2d_nearest(mask, size=image.shape[-2:])
+            masks.append(rearrange(mask, '1 1 h w -> h w'))
+        return masks
+
+    def predictProbabilities(self, images: List[np.ndarray]) -> List[np.ndarray]:
+        """Tiled prediction of the fiducial probabilities of a group of (h, w) images. The tiles of all the
+        images are pooled and processed by the U-Net in batches of self.batchSize, so a tilt image with fewer
+        tiles than the batch size does not lead to an almost empty forward pass."""
+        tilers = [self._getTiler(image.shape) for image in images]
+        mergers = [Merger(tiler, window=MERGE_WINDOW) for tiler in tilers]
+        tileIds = [(imageId, tileId) for imageId, tiler in enumerate(tilers) for tileId in range(tiler.n_tiles)]
+        batches = [tileIds[start:start + self.batchSize] for start in range(0, len(tileIds), self.batchSize)]
+        nextUpload = self._toDevice(self._getTiles(tilers, images, batches[0]), 0)
+        previousBatch = None
+        for batchNum, batchTileIds in enumerate(batches):
+            tiles = self._waitForUpload(*nextUpload)
+            tiles = normalise_2d(tiles)
+            tiles = rearrange(tiles, 'b h w -> b 1 h w').contiguous(memory_format=torch.channels_last)
+            prediction = self.model(tiles)
+            probabilities = F.softmax(prediction, dim=1)[:len(batchTileIds), 1, ...]
+            download = self._toHost(probabilities, batchNum % 2)
+            # The GPU work is asynchronous: while the current batch is being computed, the next one is extracted
+            # and uploaded, and the results of the previous one are merged
+            if batchNum + 1 < len(batches):
+                nextUpload = self._toDevice(self._getTiles(tilers, images, batches[batchNum + 1]),
+                                            (batchNum + 1) % 2)
+            if previousBatch:
+                self._mergeBatch(mergers, *previousBatch)
+            previousBatch = (batchTileIds, *download)
+        self._mergeBatch(mergers, *previousBatch)
+        return [merger.merge(unpad=True) for merger in mergers]
+
+    @staticmethod
+    def _mergeBatch(mergers: List[Merger], batchTileIds: List[Tuple[int, int]], probabilities: np.ndarray,
+                    downloadEvent: Optional[torch.cuda.Event]) -> None:
+        if downloadEvent is not None:
+            downloadEvent.synchronize()
+        for (imageId, tileId), tileProbabilities in zip(batchTileIds, probabilities):
+            mergers[imageId].add(tileId, tileProbabilities)
+
+    @staticmethod
+    def _getTiles(tilers: List[Tiler], images: List[np.ndarray], batchTileIds: List[Tuple[int, int]]) -> np.ndarray:
+        return np.stack([tilers[imageId].get_tile(images[imageId], tileId) for imageId, tileId in batchTileIds])
+
+    def _getDownscaledShape(self, imageShape: Tuple[int, int]) -> Tuple[int, int]:
+        """Shape of an image after _downscale (the shorter side is resized and the aspect ratio kept)."""
+        h, w = imageShape
+        shortSide = int(self._getDownscaleFactor() * min(h, w))
+        longSide = int(shortSide * max(h, w) / min(h, w))
+        return (shortSide, longSide) if h <= w else (longSide, shortSide)
+
+    def _getDownscaleFactor(self) -> float:
+        return calculate_resampling_factor(source=self.pixelSpacing, target=TRAINING_PIXEL_SIZE)
+
+    def _downscale(self, image: torch.Tensor) -> np.ndarray:
+        """Rescale an (h, w) image to the pixel size of the fidder training data."""
+        image = rearrange(image, 'h w -> 1 1 h w')
+        image = rescale_2d_bicubic(image, factor=self._getDownscaleFactor())
+        return rearrange(image, '1 1 h w -> h w').numpy()
+
+    @staticmethod
+    def _getTiler(imageShape: Tuple[int, int]) -> Tiler:
+        return Tiler(data_shape=imageShape,
+                     tile_shape=TRAINING_IMAGE_DIMENSIONS,
+                     overlap=TILE_OVERLAP,
+                     mode='reflect')
+
+    def _toDevice(self, tiles: np.ndarray, bufferId: int) -> Tuple[torch.Tensor, Optional[torch.cuda.Event]]:
+        """Start copying a batch of tiles to the device. On GPU, the tiles are staged in the given pinned
+        buffer and copied asynchronously in the copy stream. The returned event marks the end of the copy. A
+        last incomplete batch is padded by repeating its last tile, so all the forward passes have the same
+        shape (no cuDNN re-tuning or torch.compile re-compilation). The predictions of the padding tiles are
+        discarded."""
+        if self.device.type != 'cuda':
+            return torch.as_tensor(tiles, dtype=torch.float, device=self.device), None
+        pinnedTiles = self._pinnedTiles[bufferId]
+        if pinnedTiles is None or pinnedTiles.shape[1:] != tiles.shape[1:]:
+            pinnedTiles = torch.empty((self.batchSize,) + tiles.shape[1:], dtype=torch.float).pin_memory()
+            self._pinnedTiles[bufferId] = pinnedTiles
+        elif self._uploadEvents[bufferId] is not None:
+            self._uploadEvents[bufferId].synchronize()  # The previous copy from this buffer must be finished
+        hostTiles = pinnedTiles.numpy()
+        nTiles = len(tiles)
+        np.copyto(hostTiles[:nTiles], tiles, casting='unsafe')
+        hostTiles[nTiles:] = hostTiles[nTiles - 1]
+        with torch.cuda.stream(self._copyStream):
+            deviceTiles = pinnedTiles.to(self.device, non_blocking=True)
+            uploadEvent = torch.cuda.Event()
+            uploadEvent.record(self._copyStream)
+        self._uploadEvents[bufferId] = uploadEvent
+        return deviceTiles, uploadEvent
+
+    def _toHost(self, probabilities: torch.Tensor, bufferId: int) -> Tuple[np.ndarray, Optional[torch.cuda.Event]]:
+        """Start copying the float32 probabilities of a batch to the host. On GPU, they are copied
+        asynchronously into the given pinned buffer, and the returned event marks the end of the copy. The
+        buffer is reused two batches later, once its contents have been merged."""
+        if self.device.type != 'cuda':
+            return probabilities.float().numpy(), None
+        pinnedProbabilities = self._pinnedProbabilities[bufferId]
+        if pinnedProbabilities is None or pinnedProbabilities.shape[1:] != probabilities.shape[1:]:
+            pinnedProbabilities = torch.empty((self.batchSize,) + probabilities.shape[1:],
+                                              dtype=torch.float).pin_memory()
+            self._pinnedProbabilities[bufferId] = pinnedProbabilities
+        hostProbabilities = pinnedProbabilities[:len(probabilities)]
+        hostProbabilities.copy_(probabilities, non_blocking=True)
+        downloadEvent = torch.cuda.Event()
+        downloadEvent.record()
+        return hostProbabilities.numpy(), downloadEvent
+
+    @staticmethod
+    def _waitForUpload(tiles: torch.Tensor, uploadEvent: Optional[torch.cuda.Event]) -> torch.Tensor:
+        """Make the compute stream wait for the copy of the tiles, which were allocated in the copy stream."""
+        if uploadEvent is not None:
+            computeStream = torch.cuda.current_stream(tiles.device)
+            computeStream.wait_event(uploadEvent)
+            tiles.record_stream(computeStream)
+        return tiles
+
+    def _getMaxBatchSize(self) -> int:
+        """Largest batch size whose tiles fit in AUTO_BATCH_MEMORY_FRACTION of the free GPU memory, estimated from
+        the peak memory used by the U-Net to predict a single tile."""
+        if self.device.type != 'cuda':
+            return CPU_BATCH_SIZE
+        torch.cuda.reset_peak_memory_stats(self.device)
+        baseline = torch.cuda.memory_allocated(self.device)
+        tile = torch.zeros((1, 1) + tuple(TRAINING_IMAGE_DIMENSIONS), device=self.device)
+        with torch.inference_mode(), self._getAutocast():
+            self.model(tile)
+        bytesPerTile = torch.cuda.max_memory_allocated(self.device) - baseline
+        del tile
+        torch.cuda.empty_cache()
+        freeBytes, _ = torch.cuda.mem_get_info(self.device)
+        batchSize = max(1, min(int(freeBytes * AUTO_BATCH_MEMORY_FRACTION / bytesPerTile), MAX_AUTO_BATCH_SIZE))
+        print(f'Batch size: {batchSize} tiles', flush=True)
+        return batchSize
+
+    def _getAutocastDtype(self, precision: str) -> Optional[torch.dtype]:
+        """Data type used for the mixed precision inference, or None for fp32."""
+        if precision == FP32:
+            return None
+        if self.device.type != 'cuda':
+            print(f'No GPU available: running the U-Net in {FP32} instead of {precision}.', flush=True)
+            return None
+        # Native bf16 support (Ampere and newer GPUs). The compute capability is checked instead of
+        # torch.cuda.is_bf16_supported, which may also accept older GPUs that only emulate it
+        if precision == BF16 and torch.cuda.get_device_capability(self.device)[0] < 8:
+            print(f'The GPU does not support {BF16}: running the U-Net in {FP32}.', flush=True)
+            return None
+        return AUTOCAST_DTYPES[precision]
+
+    def _getAutocast(self):
+        if self.autocastDtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type='cuda', dtype=self.autocastDtype)
+
+
+def probabilitiesToMask(probabilities: np.ndarray, threshold: float, minPixelCount: int) -> np.ndarray:
+    """Threshold the probabilities and remove the connected regions smaller than minPixelCount pixels, as
+    fidder.predict.probabilities_to_mask does. The size of all the regions is counted at once with a
+    bincount of the labels, instead of a pass over the whole image per region."""
+    mask = probabilities > threshold
+    labels, _ = ndi.label(mask)
+    keep = np.bincount(labels.ravel()) >= minPixelCount
+    keep[0] = False  # Background
+    return keep[labels]
+
+
+_threadData = threading.local()
+
+
+def getRng() -> np.random.Generator:
+    """Random generator of the calling thread, created once (numpy generators are not thread-safe)."""
+    if not hasattr(_threadData, 'rng'):
+        _threadData.rng = np.random.default_rng()
+    return _threadData.rng
+
+
+def eraseImage(image: torch.Tensor, mask: torch.Tensor) -> np.ndarray:
+    """Inpaint the masked pixels with gaussian noise matching the local mean and the global standard deviation
+    of the background, as fidder.erase.erase_masked_region does. It works directly on numpy arrays and the
+    local mean model is only evaluated at the masked pixels, instead of over the whole image."""
+    image = image.numpy()
+    mask = mask.numpy().astype(bool, copy=False)
+    erased = image.astype(np.float32, copy=True)
+    yMasked, xMasked = np.nonzero(mask)
+    if len(yMasked) == 0:
+        return erased
+    background = np.logical_not(mask)
+    localMean = fitBackgroundModel(image, background)(yMasked, xMasked, grid=False)
+    noise = getRng().standard_normal(len(yMasked), dtype=np.float32)
+    noise *= estimateBackgroundStd(image, background)
+    erased[yMasked, xMasked] = localMean + noise
+    return erased
+
+
+def fitBackgroundModel(image: np.ndarray, background: np.ndarray) -> LSQBivariateSpline:
+    """Bicubic spline fitted to a random sample of BACKGROUND_MODEL_SAMPLES background pixels, or to all of
+    them if there are fewer (fidder fits a single pixel in that case, due to an operator precedence issue)."""
+    sampleIds = np.flatnonzero(background)
+    if len(sampleIds) > BACKGROUND_MODEL_SAMPLES:
+        # Unlike the legacy np.random.choice, Generator.choice does not permute the whole population to sample
+        # without replacement
+        sampleIds = getRng().choice(sampleIds, size=BACKGROUND_MODEL_SAMPLES, replace=False)
+    y, x = np.unravel_index(sampleIds, image.shape)
+    # Same knots as in fidder, which passes them in (x, y) order
+    ty = np.linspace(0, image.shape[0], num=BACKGROUND_MODEL_RESOLUTION[0])
+    tx = np.linspace(0, image.shape[1], num=BACKGROUND_MODEL_RESOLUTION[1])
+    return LSQBivariateSpline(y, x, image[y, x], tx, ty)
+
+
+def estimateBackgroundStd(image: np.ndarray, background: np.ndarray) -> float:
+    """Standard deviation of the background pixels of the central crop of the image."""
+    h, w = image.shape
+    dh, dw = int(h * BACKGROUND_STD_CROP / 2), int(w * BACKGROUND_STD_CROP / 2)
+    crop = (slice(h // 2 - dh, h // 2 + dh), slice(w // 2 - dw, w // 2 + dw))
+    return float(np.std(image[crop][background[crop]], ddof=1, dtype=np.float64))
+
+
+def main():
+    args = parseArgs()
+    # The even/odd stacks are erased with the masks predicted for the full tilt images
+    inFiles = [args.input_stack, args.input_even, args.input_odd]
+    outFiles = [args.output_stack, args.output_even, args.output_odd]
+    mrcs = [openStack(inFile) for inFile in inFiles]
+    stacks = [getStackData(mrc) if mrc else None for mrc in mrcs]
+    nImgs = len(stacks[0])
+    nStacks = sum(stack is not None for stack in stacks)
+    outMrcs = [newStack(outFile, stack.shape, np.float32) if stack is not None else None
+               for outFile, stack in zip(outFiles, stacks)]
+    results = [mrc.data if mrc else None for mrc in outMrcs]
+    maskMrc = newStack(args.output_mask, stacks[0].shape, np.int8)
+    masks = maskMrc.data if maskMrc else None
+    resultsStats = [StackStats() for _ in results]
+    masksStats = StackStats()
+    model = loadModel(args.batch_size)
+    predictor = FiducialPredictor(model, args.pixel_spacing, args.probability_threshold, precision=args.precision)
+    groupSize = predictor.fitToImageShape(stacks[0].shape[-2:])
+    if args.compile:
+        # After the batch size is set, so the model is only compiled for the batch size used
+        compileForward(model)
+        predictor.warmUp()
+
+    t0 = time.time()
+    predictTime = 0
+    try:
+        # The tilt images are predicted in groups, whose tiles fill the U-Net batches. Pipeline: the tilt images
+        # of the next group are read while the current ones are being predicted (GPU), and the erasing (CPU) of
+        # each group overlaps with the prediction of the next one
+        groups = [range(start, min(start + groupSize, nImgs)) for start in range(0, nImgs, groupSize)]
+        with ThreadPoolExecutor(max_workers=nStacks) as reader, ThreadPoolExecutor(max_workers=nStacks) as eraser:
+            pendingReads = submitReads(reader, stacks, groups[0])
+            pendingErases = []
+            for groupId, group in enumerate(groups):
+                groupImages = getResults(pendingReads)
+                if groupId + 1 < len(groups):
+                    pendingReads = submitReads(reader, stacks, groups[groupId + 1])
+                tPredict = time.time()
+                groupMasks = [mask.cpu() for mask in predictor.predictMasks([images[0] for images in groupImages])]
+                predictTime += time.time() - tPredict
+                if masks is not None:
+                    for i, mask in zip(group, groupMasks):
+                        masks[i] = mask.numpy()
+                        masksStats.add(masks[i])
+                # Only the tilt images of one group are erased at a time, which bounds the memory in use. The
+                # stacks (full and even/odd) are erased concurrently, as they only share the masks
+                waitAll(pendingErases)
+                pendingErases = [eraser.submit(eraseInto, result, stats, group,
+                                               [images[stackId] for images in groupImages], groupMasks)
+                                 for stackId, (result, stats) in enumerate(zip(results, resultsStats))
+                                 if result is not None]
+            waitAll(pendingErases)
+        for mrc, stats in zip(outMrcs, resultsStats):
+            if mrc:
+                finishStack(mrc, stats, args.pixel_spacing)
+        if maskMrc:
+            finishStack(maskMrc, masksStats, args.pixel_spacing)
+    finally:
+        for mrc in mrcs + outMrcs + [maskMrc]:
+            if mrc:
+                mrc.close()
+
+    # A single summary line per tilt-series, instead of one per tilt image
+    print(f'{nImgs} images processed in {time.time() - t0:.2f} s (prediction: {predictTime:.2f} s)', flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -40,6 +40,7 @@ from tomo.tests.test_base_centralized_layer import TestBaseCentralizedLayer
 
 class TestFidder(TestBaseCentralizedLayer):
     alignedTs = None
+    binnedAlignedTs = None
     unbinnedSRate = DataSetRe4STATuto.unbinnedPixSize.value
     binFactor = 4
     expectedTsSetSize = 2
@@ -72,6 +73,8 @@ class TestFidder(TestBaseCentralizedLayer):
     def _runPreviousProtocols(cls):
         importedTs = cls._runImportTs()
         cls.alignedTs = cls._runImportTrMatrix(importedTs)
+        # Shared by all the tests, as the binning is the same for all of them
+        cls.binnedAlignedTs = cls._runTsPreprocess(cls.alignedTs, binning=cls.binFactor)
 
     @classmethod
     def _runImportTs(cls, filesPattern=DataSetRe4STATuto.tsPattern.value,
@@ -92,7 +95,7 @@ class TestFidder(TestBaseCentralizedLayer):
                                        tiltAxisAngle=DataSetRe4STATuto.tiltAxisAngle.value)
 
         cls.launchProtocol(protImportTs)
-        tsImported = getattr(protImportTs, ProtImportTsBase.OUTPUT_NAME, None)
+        tsImported = cls._getOutput(protImportTs, ProtImportTsBase.OUTPUT_NAME)
         return tsImported
 
     @classmethod
@@ -103,7 +106,7 @@ class TestFidder(TestBaseCentralizedLayer):
                                              filesPattern=DataSetRe4STATuto.transformPattern.value,
                                              inputSetOfTiltSeries=inTsSet)
         cls.launchProtocol(protImportTrMatrix)
-        outTsSet = getattr(protImportTrMatrix, OUTPUT_TILTSERIES_NAME, None)
+        outTsSet = cls._getOutput(protImportTrMatrix, OUTPUT_TILTSERIES_NAME)
         return outTsSet
 
     @classmethod
@@ -114,28 +117,42 @@ class TestFidder(TestBaseCentralizedLayer):
                                      inputSetOfTiltSeries=inTsSet,
                                      binning=binning)
         cls.launchProtocol(protTsNorm)
-        tsPreprocessed = getattr(protTsNorm, OUTPUT_TILTSERIES_NAME, None)
+        tsPreprocessed = cls._getOutput(protTsNorm, OUTPUT_TILTSERIES_NAME)
         return tsPreprocessed
 
+    @staticmethod
+    def _getOutput(prot, outputName: str):
+        """Fail as soon as a protocol does not generate its output, instead of running the next ones."""
+        output = getattr(prot, outputName, None)
+        assert output is not None, f'{prot.getClassName()} did not generate the output {outputName}'
+        return output
+
     @classmethod
     def _excludeSetViews(cls, inSet: SetOfTiltSeries,
-                         excludedViewsDict: Union[dict, None] = None) -> None:
+                         excludedViewsDict: Union[dict, None] = None,
+                         enabled: bool = False) -> None:
+        """Disable the given views (or enable them back, if enabled is True, to undo the exclusion, so the
+        set can be used by other tests)."""
         if not excludedViewsDict:
             excludedViewsDict = cls.excludedViewsDict
         objList = [obj.clone(ignoreAttrs=[]) for obj in inSet]
         for obj in objList:
-            cls._excIntermediateSetViews(inSet, obj, excludedViewsDict[obj.getTsId()])
+            excludedViewsList = excludedViewsDict.get(obj.getTsId())
+            if excludedViewsList:  # Nothing to update for the tilt-series without excluded views
+                cls._excIntermediateSetViews(inSet, obj, excludedViewsList, enabled=enabled)
+        inSet.write()
 
     @staticmethod
-    def _excIntermediateSetViews(inSet, obj, excludedViewsList):
+    def _excIntermediateSetViews(inSet, obj, excludedViewsList, enabled=False):
+        """The set is written by the caller, once all its tilt-series have been updated."""
+        excludedViews = set(excludedViewsList)
         tiList = [ti.clone() for ti in obj]
         for i, ti in enumerate(tiList):
-            if i in excludedViewsList:
-                ti._objEnabled = False
+            if i in excludedViews:
+                ti._objEnabled = enabled
                 obj.update(ti)
         obj.write()
         inSet.update(obj)
-        inSet.write()
 
     def _checkTiltSeries(self, inTsSet, binningFactor=1, expectedDimensions=None,
                          testAcqObjDict=None, anglesCountDict=None, excludedViewsDict=None):
@@ -171,22 +188,20 @@ class TestFidder(TestBaseCentralizedLayer):
                                       numberOfThreads=3)
         protFidder.setObjLabel(f'fidder{evLabel}')
         self.launchProtocol(protFidder)
-        outTsSet = getattr(protFidder, protFidder._possibleOutputs.tiltSeries.name, None)
+        outTsSet = self._getOutput(protFidder, protFidder._possibleOutputs.tiltSeries.name)
         self._checkTiltSeries(outTsSet,
                               binningFactor=self.binFactor,
                               excludedViewsDict=excludedViewsDict)
 
     def testFidder(self):
-        binnedAlignedTs = self._runTsPreprocess(self.alignedTs,
-                                                binning=self.binFactor)
-        self._runFidderTest(binnedAlignedTs)
+        self._runFidderTest(self.binnedAlignedTs)
 
     def testFidderEv(self):
-        binnedAlignedTs = self._runTsPreprocess(self.alignedTs,
-                                                binning=self.binFactor)
-        # Exclude some views at metadata level
-        self._excludeSetViews(binnedAlignedTs)
-        self._runFidderTest(binnedAlignedTs,
+        # Exclude some views at metadata level. The set is shared with the other tests, so they are restored
+        # at the end of this one
+        self._excludeSetViews(self.binnedAlignedTs)
+        self.addCleanup(self._excludeSetViews, self.binnedAlignedTs, enabled=True)
+        self._runFidderTest(self.binnedAlignedTs,
                             excludedViewsDict=self.excludedViewsDict)
 
 